@@ -0,0 +1,14 @@
+"""
+Numba is used to compile the few numeric loops that can't be expressed as whole-array NumPy operations.  It's an
+optional dependency: without it, the decorated functions simply run as regular Python.
+"""
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        # Supports both the bare @njit and the @njit(cache=True) forms
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+
+        return lambda func: func
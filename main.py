@@ -34,7 +34,7 @@ _PATCHER_CABLIRATION_FILE = "patcher-calibration.json"
 
 def _do_calibrate(config):
     logging.info("Reading AQI files from %s" % config['aqi_files_path'])
-    aqi_data = stateair.AqiDataSet(config['aqi_files_path'])
+    aqi_data = stateair.AqiDataSet(config['aqi_files_path'], cache_dir=config['aqi_files_path'])
 
     calibration = patcher.AqiDataPatcher.calibrate_on_data(aqi_data)
     _json_fsave(_PATCHER_CABLIRATION_FILE, calibration)
@@ -44,7 +44,7 @@ def _do_calibrate(config):
 
 def _do_reports(config):
     logging.info("Reading AQI files from %s" % config['aqi_files_path'])
-    aqi_data = stateair.AqiDataSet(config['aqi_files_path'])
+    aqi_data = stateair.AqiDataSet(config['aqi_files_path'], cache_dir=config['aqi_files_path'])
 
     if not os.path.exists(_PATCHER_CABLIRATION_FILE):
         raise Exception("Calibration file {0} not found; please run --calibrate first".format(_PATCHER_CABLIRATION_FILE))
@@ -56,22 +56,17 @@ def _do_reports(config):
 
     logging.info("Patcher filled %d missing items" % patch_stats['filled-items-count'])
 
-    report = reports.DataAvailabilityReport.process(aqi_data)
-    report.write_to_file(config['reports_path'])
-
-    report = reports.MonthlyAverageReport.process(aqi_data)
-    report.write_to_file(config['reports_path'])
-
-    report = reports.SampleDistributionHistogramReport.process(aqi_data)
-    report.write_to_file(config['reports_path'])
-
-    report = reports.HourlyMeanReport.process(aqi_data)
-    report.write_to_file(config['reports_path'])
-
-    report = reports.MovingAverageReport.process(aqi_data)
-    report.write_to_file(config['reports_path'])
-    pass
-
+    report_types = [
+        reports.DataAvailabilityReport,
+        reports.MonthlyAverageReport,
+        reports.SampleDistributionHistogramReport,
+        reports.HourlyMeanReport,
+        reports.MovingAverageReport
+    ]
+
+    for report_type in report_types:
+        report = report_type.process(aqi_data)
+        report.write_to_file(config['reports_path'])
 
 if __name__ == "__main__":
 
@@ -1,4 +1,5 @@
 import os
+import re
 import shutil
 __author__ = 'Michael'
 
@@ -10,9 +11,12 @@ def clear_dir(path):
     if os.path.exists(path):
         shutil.rmtree(path)
 
+# Anything that isn't a letter or digit; \w on its own would also let underscores through
+_INVALID_FILENAME_CHARS = re.compile(r'[\W_]')
+
 def make_valid_filename(str):
     """
     From http://stackoverflow.com/questions/295135/turn-a-string-into-a-valid-filename-in-python
     """
-    return "".join((x if x.isalnum() else "_") for x in str)
+    return _INVALID_FILENAME_CHARS.sub("_", str)
 
@@ -1,7 +1,7 @@
+import os
 import unittest
-import math
+import numpy as np
 import stateair
-import statistics
 
 class AqiDataPatcher():
     # Sizes of gaps in data that should be predicted using linear interpolation
@@ -16,73 +16,76 @@ class AqiDataPatcher():
     def __init__(self, calibration):
         self.calibration = calibration
 
+        # Row gap_size - 1 holds the uncertainties for the gap_size filled samples of a gap that size
+        max_gap_size = max(AqiDataPatcher.LINEAR_INTERP_GAP_SIZES)
+        self._uncertainty_table = np.full((max_gap_size, max_gap_size), np.nan)
+        for gap_size in AqiDataPatcher.LINEAR_INTERP_GAP_SIZES:
+            self._uncertainty_table[gap_size - 1, :gap_size] = calibration['fill-uncertainty'][str(gap_size)]
+
     @staticmethod
     def calibrate_on_data(aqi_data_set):
-        my_range = aqi_data_set.data_in_range()
-
-        deltas = [[], [], [], [], [], [], []]
-
-        def _deltas_from_interp(values, x_start, x_end):
-            steps = x_end - x_start
-            return [values[x_start].value * (1 - i / steps) + values[x_end].value * (i / steps) - values[i + x_start].value for i in range(1, steps)]
-
-        for x in range(0, len(my_range)):
-            for gap_size in AqiDataPatcher.LINEAR_INTERP_GAP_SIZES:
-                if x + gap_size + 1 < len(my_range):
-                    my_deltas = _deltas_from_interp(my_range, x, x + gap_size + 1)
-                    if not math.isnan(sum(my_deltas)):
-                        deltas[gap_size - 1].append(my_deltas)
+        values = aqi_data_set.arrays().values
 
         calibration = {'fill-uncertainty': {}}
 
         for gap_size in AqiDataPatcher.LINEAR_INTERP_GAP_SIZES:
-            my_deltas = deltas[gap_size - 1]
-            means = [statistics.mean([delta_item[i] for delta_item in my_deltas]) for i in range(0, gap_size)]
+            steps = gap_size + 1
+            left = values[:-steps]
+            right = values[steps:]
 
-            calibration['fill-uncertainty'][str(gap_size)] = list([
-                statistics.stdev([delta_item[i] for delta_item in my_deltas], means[i]) for i in range(0, gap_size)
-            ])
+            # Row i - 1 holds, for every window start x, the error of interpolating sample x + i from x and x + steps
+            deltas = np.empty((gap_size, len(left)))
+            for i in range(1, steps):
+                deltas[i - 1] = left * (1 - i / steps) + right * (i / steps) - values[i:i - steps]
+
+            # Windows that touch any missing sample are left out entirely
+            complete = deltas[:, ~np.isnan(deltas).any(axis=0)]
+
+            calibration['fill-uncertainty'][str(gap_size)] = complete.std(axis=1, ddof=1).tolist()
 
         return calibration
 
 
     def estimate_missing_data(self, aqi_data_set, max_distance=1):
-        data_range = aqi_data_set.data_in_range()
+        # These are the data set's own arrays, so the gaps are filled in place
+        arrays = aqi_data_set.arrays()
+
+        values = arrays.values
+        uncertainties = arrays.uncertainty
+
+        # Runs of missing samples start where validity drops from 1 to 0 and end where it goes back up.  Padding both
+        # ends with 1 means any leading or trailing run would touch the padding; those are dropped below since there's
+        # nothing to interpolate from on one side.
+        edges = np.diff(np.r_[1, arrays.valid.astype(np.int8), 1])
+        gap_starts = np.flatnonzero(edges == -1)
+        gap_ends = np.flatnonzero(edges == 1)
+        interior = (gap_starts > 0) & (gap_ends < len(values))
+        gap_starts = gap_starts[interior]
+        gap_sizes = gap_ends[interior] - gap_starts
 
-        x = 0
-        fill_count = 0
-        # Advance to the first valid item
-        while x < len(data_range) and not data_range[x].isvalid():
-            x += 1
-
-        while x < len(data_range):
-            last_valid_x = x
-            x += 1
-            while x < len(data_range) and not data_range[x].isvalid():
-                x += 1
+        for gap_size in AqiDataPatcher.LINEAR_INTERP_GAP_SIZES:
+            starts = gap_starts[gap_sizes == gap_size]
+            if len(starts) == 0:
+                continue
 
-            # Ran off the end of the array? Don't do any more filling
-            if x == len(data_range):
-                break
+            i = np.arange(1, gap_size + 1)
+            # One row per gap, one column per missing sample in it
+            targets = starts[:, np.newaxis] + (i - 1)
+            left = values[starts - 1][:, np.newaxis]
+            right = values[starts + gap_size][:, np.newaxis]
 
-            gap_size = x - last_valid_x - 1
-            if gap_size in AqiDataPatcher.LINEAR_INTERP_GAP_SIZES:
-                uncertainties = self.calibration['fill-uncertainty'][str(gap_size)]
-                for i in range(1, gap_size + 1):
-                    data_range[last_valid_x + i].value = (
-                        data_range[last_valid_x].value * (1 - i / (gap_size + 1)) + data_range[x].value * i / (gap_size + 1)
-                    )
-                    data_range[last_valid_x + i].uncertainty = uncertainties[i - 1]
+            values[targets] = left * (1 - i / (gap_size + 1)) + right * i / (gap_size + 1)
+            uncertainties[targets] = self._uncertainty_table[gap_size - 1, :gap_size]
 
-            fill_count += gap_size
+        aqi_data_set.invalidate_arrays()
 
-        return {'filled-items-count': fill_count}
+        return {'filled-items-count': int(gap_sizes.sum())}
 
 
 class UnitTests(unittest.TestCase):
 
     def test_calibration(self):
-        data = stateair.AqiDataSet("unittest\\test-data", "test2.csv")
+        data = stateair.AqiDataSet(os.path.join("unittest", "test-data"), "test2.csv")
 
         calibration = AqiDataPatcher.calibrate_on_data(data)
 
@@ -98,7 +101,7 @@ class UnitTests(unittest.TestCase):
 
 
     def test_fill(self):
-        data = stateair.AqiDataSet("unittest\\test-data", "test2.csv")
+        data = stateair.AqiDataSet(os.path.join("unittest", "test-data"), "test2.csv")
 
         calibration = AqiDataPatcher.calibrate_on_data(data)
         patcher = AqiDataPatcher(calibration)
@@ -1,31 +1,36 @@
 import stateair
 import datetime
+import functools
+import math
+import tempfile
+import unittest
 import osutils
-import csv
 import os
 import logging
-import statistics
+import numpy as np
+import pandas as pd
 
 class CsvReport:
     def __init__(self, description, fields):
         self.description = description
         self.fields = fields
-        self.data = []
+        self.columns = {}
 
-    def append_data(self, moredata):
-        self.data.append(moredata)
+    def set_columns(self, columns):
+        """
+        Sets the report's data, as a dict from field name to a sequence (usually a NumPy array) holding that column.
+        All columns must have the same length.
+        """
+        self.columns = columns
 
     def write_to_file(self, report_path):
         osutils.ensure_dir(report_path)
 
         filename = os.path.join(report_path, osutils.make_valid_filename(self.description) + ".csv")
-        logging.info("Writing report with {0} lines to '{1}'".format(len(self.data), filename))
+        table = pd.DataFrame(self.columns, columns=self.fields)
+        logging.info("Writing report with {0} lines to '{1}'".format(len(table), filename))
 
-        with open(filename, 'w', newline='\n') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=self.fields)
-
-            writer.writeheader()
-            [writer.writerow(row) for row in self.data]
+        table.to_csv(filename, index=False, lineterminator='\r\n')
 
 
 
@@ -35,22 +40,53 @@ class AqiReportBase:
     def process(cls, aqi_data):
         pass
 
-def _month_data(aqi_data, period: datetime.date):
+def _sum_by_month(x, boundaries):
+    """
+    Sums x over each of the slices x[boundaries[i]:boundaries[i + 1]].  The last boundary must be len(x).
+    """
+    # The padding keeps every index valid, because months after the end of the data start at len(x)
+    sums = np.add.reduceat(np.append(x, 0), boundaries[:-1])
+    # reduceat returns x[i] rather than 0 for empty slices
+    sums[boundaries[:-1] == boundaries[1:]] = 0
+    return sums
+
+
+@functools.lru_cache(maxsize=None)
+def _month_bounds(year_begin, year_end):
+    """
+    Returns the start of every month from January of year_begin through January of the year after year_end, in epoch
+    seconds, and the number of hours in each month of those years as a (year, month) array.  Every report that
+    tabulates by month asks for the same years, so the result is cached; the arrays are read-only for that reason.
     """
-    Returns the data for the month into which the date 'period' falls.
+    month_starts = np.arange(np.datetime64('{0}-01'.format(year_begin)), np.datetime64('{0}-02'.format(year_end + 1)))
+    month_starts = month_starts.astype('datetime64[s]').astype(np.int64)
+    month_hours = (np.diff(month_starts) // 3600).reshape(-1, 12)
+
+    month_starts.flags.writeable = False
+    month_hours.flags.writeable = False
+    return month_starts, month_hours
+
+
+def _monthly_totals(aqi_data):
+    """
+    Bins all samples into (year, month) buckets, using the month boundaries in the (sorted) sample times to turn each
+    month into a contiguous slice of the data.
     :param aqi_data:
-    :param period:
-    :return:
+    :return: The first year, and three (year, month) arrays: the number of hours in each month, the number of valid
+             samples and the sum of the valid samples.  The hour counts cover the whole month, even where the data
+             starts or ends partway through it.
     """
-    month_begin = datetime.date(period.year, period.month, 1)
+    arrays = aqi_data.arrays()
+    year_begin = int(arrays.year[0])
+    year_end = int(arrays.year[-1])
 
-    month_end_index = period.month + 1
-    year_end_index = period.year
-    if month_end_index == 13:
-        year_end_index += 1
-        month_end_index = 1
+    month_starts, month_hours = _month_bounds(year_begin, year_end)
+    boundaries = np.searchsorted(arrays.epoch, month_starts)
 
-    return aqi_data.data_in_range(month_begin, datetime.date(year_end_index, month_end_index, 1))
+    valid_counts = _sum_by_month(arrays.valid.astype(np.int64), boundaries).reshape(-1, 12)
+    sums = _sum_by_month(np.where(arrays.valid, arrays.values, 0), boundaries).reshape(-1, 12)
+
+    return year_begin, month_hours, valid_counts, sums
 
 
 class DataAvailabilityReport(AqiReportBase):
@@ -58,27 +94,36 @@ class DataAvailabilityReport(AqiReportBase):
     @classmethod
     def process(cls, aqi_data: stateair.AqiDataSet):
 
-        all_data = aqi_data.data_in_range()
-
-        year_begin = all_data[0].date.date().year
-        year_end = all_data[-1].date.date().year
+        year_begin, month_hours, valid_counts, sums = _monthly_totals(aqi_data)
+        year_end = year_begin + len(month_hours) - 1
 
         report = CsvReport(
             "Data Availability: {0} to {1}".format(year_begin, year_end),
             ['year'] + [str(i) for i in range(1, 13)])
 
-        for year in range(year_begin, year_end + 1):
-            new_row = { 'year': year }
+        availability = valid_counts / month_hours
 
-            for month in range(1, 13):
-                month_data = _month_data(aqi_data, datetime.date(year, month, 1))
-                new_row[str(month)] = month_data.valid_data_point_count() / len(month_data)
-
-            report.append_data(new_row)
+        columns = {'year': np.arange(year_begin, year_end + 1)}
+        columns.update(zip(report.fields[1:], availability.T))
+        report.set_columns(columns)
 
         return report
 
 
+def _window_sums(x, window_size):
+    """
+    Returns the sums of every run of window_size consecutive elements of x, or NaN for runs containing a NaN.  Taking
+    differences of running sums makes this O(len(x)) however large the window is.
+    """
+    missing = np.isnan(x)
+    running_sums = np.cumsum(np.r_[0, np.where(missing, 0, x)])
+    running_missing = np.cumsum(np.r_[0, missing])
+
+    sums = running_sums[window_size:] - running_sums[:-window_size]
+    sums[running_missing[window_size:] - running_missing[:-window_size] > 0] = np.nan
+    return sums
+
+
 class MovingAverageReport(AqiReportBase):
     """
     Returns data that shows, for each set of samples from a moving window, what are the
@@ -87,8 +132,7 @@ class MovingAverageReport(AqiReportBase):
 
     @classmethod
     def process(cls, aqi_data: stateair.AqiDataSet):
-        import math
-        all_data = aqi_data.data_in_range()
+        arrays = aqi_data.arrays()
 
         year = 2013
         window_size = datetime.timedelta(days=15)
@@ -98,36 +142,38 @@ class MovingAverageReport(AqiReportBase):
         # of samples.
         window_half_size_in_samples = int(window_size.total_seconds() // 3600 // 2)
         window_size_in_samples = window_half_size_in_samples * 2 + 1
-        window_begin_offset = datetime.timedelta(hours=window_half_size_in_samples)
-        window_end_offset = datetime.timedelta(hours=(window_half_size_in_samples + 1))
         exp_factor = 20 * 24  # In samples, aka hours
 
-        # Simple moving average
-        kernel_func = [1 / window_size_in_samples for i in range(0, window_size_in_samples)]
-
         date_begin = datetime.datetime(year, 1, 1)
         date_end = datetime.datetime(year + 1, 1, 1)
         domain_total_days = int((date_end - date_begin).total_seconds() // 86400)
 
-        report = CsvReport(
-            "Moving average and N stdev: {0}".format(year),
-            ['day'] + [str(year), str(year) + '-dx', str(year) + '-raw'])
+        count = len(arrays.values)
 
-        for day in range(0, domain_total_days):
-            new_row = { 'day': day }
-            center_datetime = date_begin + datetime.timedelta(days=day, hours=12)
+        # Indexed by the window's center sample; windows that run off either end of the data stay NaN
+        averages = np.full(count, np.nan)
+        dxs = np.full(count, np.nan)
+        if count >= window_size_in_samples:
+            center_slice = slice(window_half_size_in_samples, count - window_half_size_in_samples)
+            # Simple moving average
+            averages[center_slice] = _window_sums(arrays.values, window_size_in_samples) / window_size_in_samples
+            # Standard uncertainty propagation: every sample is weighted by 1 / window_size_in_samples
+            dxs[center_slice] = np.sqrt(_window_sums(arrays.uncertainty * arrays.uncertainty, window_size_in_samples)) / window_size_in_samples
 
-            window_data = aqi_data.data_in_range(center_datetime - window_begin_offset, center_datetime + window_end_offset)
-            avg = sum([window_data[x].value * kernel_func[x] for x in range(0, window_size_in_samples)])
-            # Standard uncertainty propagation
-            dx = math.sqrt(sum([y * y for y in
-                                [abs(kernel_func[x]) * window_data[x].uncertainty for x in range(0, window_size_in_samples)]]))
+        centers = np.datetime64(date_begin, 's').astype(np.int64) + (np.arange(domain_total_days) * 24 + 12) * 3600
+        center_indices = np.minimum(np.searchsorted(arrays.epoch, centers), count - 1)
+        in_data = arrays.epoch[center_indices] == centers
 
-            new_row[str(year)] = avg
-            new_row[str(year) + '-dx'] = dx
-            new_row[str(year) + '-raw'] = window_data[window_half_size_in_samples].value
+        report = CsvReport(
+            "Moving average and N stdev: {0}".format(year),
+            ['day'] + [str(year), str(year) + '-dx', str(year) + '-raw'])
 
-            report.append_data(new_row)
+        report.set_columns({
+            'day': np.arange(domain_total_days),
+            str(year): np.where(in_data, averages[center_indices], np.nan),
+            str(year) + '-dx': np.where(in_data, dxs[center_indices], np.nan),
+            str(year) + '-raw': np.where(in_data, arrays.values[center_indices], np.nan),
+        })
 
         return report
 
@@ -139,29 +185,20 @@ class MonthlyAverageReport(AqiReportBase):
 
     @classmethod
     def process(cls, aqi_data: stateair.AqiDataSet):
-        all_data = aqi_data.data_in_range()
-
-        year_begin = all_data[0].date.date().year
-        year_end = all_data[-1].date.date().year
+        year_begin, month_hours, valid_counts, sums = _monthly_totals(aqi_data)
+        year_end = year_begin + len(month_hours) - 1
 
         report = CsvReport(
             "Monthly Average: {0} to {1}".format(year_begin, year_end),
             ['year'] + [str(i) for i in range(1, 13)])
 
-        for year in range(year_begin, year_end + 1):
-            new_row = {'year': year}
-
-            for month in range(1, 13):
-                month_data = _month_data(aqi_data, datetime.date(year, month, 1))
-                valid_count = month_data.valid_data_point_count()
-                available_frac = valid_count / len(month_data)
+        available_fracs = valid_counts / month_hours
+        # Months with less than 80% of their data get no average at all
+        averages = np.where(available_fracs < .8, np.nan, sums / np.maximum(valid_counts, 1))
 
-                if available_frac < .8:
-                    new_row[str(month)] = None
-                else:
-                    new_row[str(month)] = sum([p.value for p in month_data if p.isvalid()]) / valid_count
-
-            report.append_data(new_row)
+        columns = {'year': np.arange(year_begin, year_end + 1)}
+        columns.update(zip(report.fields[1:], averages.T))
+        report.set_columns(columns)
 
         return report
 
@@ -176,7 +213,6 @@ class SampleDistributionHistogramReport(AqiReportBase):
 
     @classmethod
     def process(cls, aqi_data: stateair.AqiDataSet):
-        all_data = aqi_data.data_in_range()
         MAX_VALUE = 500
 
         report = CsvReport(
@@ -184,21 +220,20 @@ class SampleDistributionHistogramReport(AqiReportBase):
             ["U", "PU"]
         )
 
-        samples = [x.value for x in all_data if x.isvalid() and 5 <= x.date.date().month <= 9]
-        bucket_counts = [0 for i in range(0, MAX_VALUE)]
-
-        for sample in samples:
-            int_sample = int(sample)
-            if int_sample < len(bucket_counts):
-                bucket_counts[int_sample] += 1
+        arrays = aqi_data.arrays()
+        samples = arrays.values[arrays.valid & (arrays.month >= 5) & (arrays.month <= 9)]
+        int_samples = samples.astype(np.int64)
+        bucket_counts = np.bincount(int_samples[int_samples < MAX_VALUE], minlength=MAX_VALUE)
 
-        overall_mean = statistics.mean(samples)
-        logging.info("Analyzed {0} samples. Mean = {1}, Stdev = {2}".format(len(samples), overall_mean, statistics.stdev(samples, overall_mean) / overall_mean))
+        overall_mean = float(samples.mean())
+        logging.info("Analyzed {0} samples. Mean = {1}, Stdev = {2}".format(len(samples), overall_mean, samples.std(ddof=1) / overall_mean))
 
-        logging.warning("Discarded {0} points because they were outside the bucket range".format(len(all_data) - len(samples)))
+        logging.warning("Discarded {0} points because they were outside the bucket range".format(len(arrays.values) - len(samples)))
 
-        for i in range(0, len(bucket_counts)):
-            report.append_data({'U': i / overall_mean, 'PU': bucket_counts[i] / len(samples) * overall_mean})
+        report.set_columns({
+            'U': np.arange(len(bucket_counts)) / overall_mean,
+            'PU': bucket_counts / len(samples) * overall_mean
+        })
 
         return report
 
@@ -206,24 +241,102 @@ class HourlyMeanReport(AqiReportBase):
 
     @classmethod
     def process(cls, aqi_data: stateair.AqiDataSet):
-        all_data = aqi_data.data_in_range()
+        arrays = aqi_data.arrays()
 
         report = CsvReport(
             "Hourly Mean",
             ["Hour", "Count", "Mean"]
         )
 
-        samples = [x for x in all_data if x.isvalid()]
-        hour_dict = [{'sum': 0, 'count': 0} for x in range(24)]
+        hours = arrays.hour[arrays.valid]
+        values = arrays.values[arrays.valid]
 
-        for sample in samples:
-            hour_info = hour_dict[sample.date.time().hour]
-            hour_info['sum'] += sample.value
-            hour_info['count'] += 1
+        counts = np.bincount(hours, minlength=24)
+        means = np.bincount(hours, weights=values, minlength=24) / counts
 
-        for hour in range(0, 24):
-            hour_info = hour_dict[hour]
-            report.append_data({'Hour': hour, 'Count': hour_info['count'], 'Mean': hour_info['sum'] / hour_info['count']})
+        report.set_columns({'Hour': np.arange(24), 'Count': counts, 'Mean': means})
 
         return report
 
+
+class UnitTests(unittest.TestCase):
+
+    @staticmethod
+    def _load_data_set(directory, date_begin, values):
+        """
+        Writes hourly values starting at date_begin to a CSV file in directory, then loads it.  NaN values are written
+        as missing samples.
+        """
+        with open(os.path.join(directory, "data.csv"), "w", encoding="latin-1") as file:
+            file.write("Site,Parameter,Date (LST),Year,Month,Day,Hour,Value,Unit,Duration,QC Name\n")
+            for i, value in enumerate(values):
+                date = date_begin + datetime.timedelta(hours=i)
+                file.write("Beijing,PM2.5,{0:%Y-%m-%d %H:%M},{0.year},{0.month},{0.day},{0.hour},{1},µg/m³,1 Hr,{2}\n".format(
+                    date, -999 if math.isnan(value) else value, "Missing" if math.isnan(value) else "Valid"))
+
+        return stateair.AqiDataSet(directory, "data.csv")
+
+    def test_window_sums(self):
+        x = np.array([1, 2, math.nan, 4, 5, 6, 7])
+
+        np.testing.assert_array_equal(_window_sums(x, 3), [math.nan, math.nan, math.nan, 15, 18])
+        np.testing.assert_array_equal(_window_sums(x, 1), x)
+        np.testing.assert_array_equal(_window_sums(x, 7), [math.nan])
+
+    def test_sum_by_month(self):
+        x = np.array([1, 2, 3, 4])
+
+        # Months with no samples, including ones past the end of the data, sum to 0
+        np.testing.assert_array_equal(_sum_by_month(x, np.array([0, 0, 2, 2, 4, 4])), [0, 3, 0, 7, 0])
+
+    def test_moving_average(self):
+        # 30 days of data from the start of the report's year, with one missing sample
+        values = [float(i % 24) for i in range(30 * 24)]
+        values[100] = math.nan
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            report = MovingAverageReport.process(self._load_data_set(temp_dir, datetime.datetime(2013, 1, 1), values))
+
+        averages = report.columns['2013']
+        self.assertEqual(len(averages), 365)
+
+        for day in range(365):
+            center = day * 24 + 12
+            window = values[center - 180:center + 181]
+            # Windows that run off the start or end of the data, or that contain a missing sample, have no average
+            if center < 180 or center + 180 >= len(values) or any(math.isnan(v) for v in window):
+                self.assertTrue(math.isnan(averages[day]), "day {0} should have no average".format(day))
+            else:
+                self.assertAlmostEqual(averages[day], np.mean(window), 9, "day {0}".format(day))
+                self.assertEqual(report.columns['2013-dx'][day], 0, "day {0}".format(day))
+
+        # Days 12 to 21 are the only ones whose windows lie within the data and miss the missing sample
+        self.assertEqual([d for d in range(365) if not math.isnan(averages[d])], list(range(12, 22)))
+
+        self.assertEqual(report.columns['2013-raw'][29], values[29 * 24 + 12])
+        self.assertTrue(math.isnan(report.columns['2013-raw'][30]), "no data after day 29")
+
+    def test_monthly_reports(self):
+        # Starts partway through March and ends on the first day of May, with one sample missing in April
+        date_begin = datetime.datetime(2013, 3, 15)
+        values = [float(i % 24) for i in range((17 + 30 + 1) * 24)]
+        april = slice(17 * 24, 47 * 24)
+        values[april.start + 5] = math.nan
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            data = self._load_data_set(temp_dir, date_begin, values)
+            availability = DataAvailabilityReport.process(data).columns
+            averages = MonthlyAverageReport.process(data).columns
+
+        self.assertEqual(list(availability['year']), [2013])
+        self.assertEqual(availability['1'][0], 0, "no samples in January")
+        self.assertEqual(availability['2'][0], 0, "no samples in February")
+        self.assertAlmostEqual(availability['3'][0], 17 * 24 / (31 * 24), 9)
+        self.assertAlmostEqual(availability['4'][0], (30 * 24 - 1) / (30 * 24), 9)
+        self.assertAlmostEqual(availability['5'][0], 24 / (31 * 24), 9)
+        self.assertEqual(availability['12'][0], 0)
+
+        april_values = [v for v in values[april] if not math.isnan(v)]
+        self.assertAlmostEqual(averages['4'][0], sum(april_values) / len(april_values), 9)
+        for month in ['1', '2', '3', '5', '12']:
+            self.assertTrue(math.isnan(averages[month][0]), "month {0} has less than 80% of its data".format(month))
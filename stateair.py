@@ -1,10 +1,38 @@
 import logging
 import os
-import io
 import datetime
+import fnmatch
+import hashlib
+import math
+import shutil
+import tempfile
 import unittest
-import collections
-import bisect
+import unittest.mock
+import collections.abc
+import numpy as np
+import pandas as pd
+from jitutils import njit
+
+_NAN = float('nan')
+_isnan = math.isnan
+_ONE_HOUR = datetime.timedelta(hours=1)
+
+
+# Kernels for jitted code work on the raw value array and integer indexes into it; they can't take dates, since Numba
+# can't construct datetime or datetime64 values.  fastmath is left off because it lets Numba assume there are no NaNs.
+@njit(cache=True)
+def _nan_mean(values, start, stop):
+    """
+    Returns the mean of the non-NaN values in values[start:stop], or NaN if there aren't any.
+    """
+    total = 0.0
+    count = 0
+    for i in range(start, stop):
+        if not math.isnan(values[i]):
+            total += values[i]
+            count += 1
+
+    return total / count if count > 0 else math.nan
 
 
 class AqiDataSet:
@@ -14,172 +42,255 @@ class AqiDataSet:
 
     @staticmethod
     def _files_matching(path, pattern):
-        import fnmatch
-
-        full_names = [os.path.join(path, f) for f in os.listdir(path)]
-        return [f for f in full_names
-                if os.path.isfile(f) and
-                fnmatch.fnmatch(os.path.basename(f), pattern)]
+        # Match on the name first: is_file() can usually answer from the directory entry, without a stat call
+        with os.scandir(path) as entries:
+            return [e.path for e in entries
+                    if fnmatch.fnmatch(e.name, pattern) and e.is_file()]
+
+    # The columns read from each CSV file, and how to parse them
+    _CSV_COLUMN_TYPES = {
+        'Site': 'category',
+        'Parameter': 'category',
+        'Year': 'int16',
+        'Month': 'int8',
+        'Day': 'int8',
+        'Hour': 'int8',
+        'Value': 'float64',
+        'Unit': 'category',
+        'Duration': 'category',
+        'QC Name': 'category'
+    }
+
+    # The header is expected within the first few lines; a file without one within this many isn't AQI data
+    _MAX_HEADER_SCAN = 64
 
     @staticmethod
     def _load_csv_skip_header(filename):
         """
         Loads a CSV file by skipping all lines before the list of fields in the CSV file.  Assumes
-        there's at least two fields in the CSV file.
-        :return:
+        there's at least two fields in the CSV file, and raises if there's no header near the top of it.
+        :return: A DataFrame with the Site, Parameter, Date and Value of every usable row.  Values that failed QC
+                 are NaN.
         """
-        import itertools
-        import csv
-        import math
-
-        skip_lines = 0
-        found_header = False
+        header = None
 
-        def _is_valid_field_name(field):
-            return len(field) > 0 and field == field.strip()
+        with open(filename, "r", encoding="latin-1") as file:
+            # Only read up to the header; pandas carries on from there with the rest of the file
+            for i, line in enumerate(file):
+                if i >= AqiDataSet._MAX_HEADER_SCAN:
+                    break
 
-        with open(filename, "r") as file:
-            for line in file.readlines():
+                # Every field name has to be non-empty, with no surrounding whitespace
                 split_line = line.strip().split(',')
-                valid_fields = [t for t in split_line if _is_valid_field_name(t)]
-
-                if len(split_line) > 1 and len(split_line) == len(valid_fields):
-                    found_header = True
+                if len(split_line) > 1 and all(t and t == t.strip() for t in split_line):
+                    header = split_line
                     break
 
-                skip_lines += 1
-
-            if (not found_header):
-                logging.warning("Couldn't find CSV header in file '{0}'".format(filename))
+            if (header is None):
+                raise BaseException("Couldn't find CSV header in the first {0} lines of file '{1}'".format(
+                    AqiDataSet._MAX_HEADER_SCAN, filename))
 
-            file.seek(0, io.SEEK_SET)
+            frame = pd.read_csv(file, header=None, names=header,
+                                usecols=list(AqiDataSet._CSV_COLUMN_TYPES), dtype=AqiDataSet._CSV_COLUMN_TYPES)
 
-            file_without_header = itertools.islice(file, skip_lines, None)
-
-            return list([r for r in [AqiDataSet._standardize_row_format(row) for row in csv.DictReader(file_without_header)]
-                        if r is not None])
-
-    @staticmethod
-    def _standardize_row_format(row):
-        import math
-        row["Date"] = datetime.datetime(int(row["Year"]), int(row["Month"]), int(row["Day"]), int(row["Hour"]))
-
-        if row["QC Name"] != "Valid" or float(row["Value"]) < 0:
-            row["Value"] = math.nan
-        else:
-            row["Value"] = float(row["Value"])
+        frame["Date"] = pd.to_datetime(frame[["Year", "Month", "Day", "Hour"]].rename(columns=str.lower))
+        frame.loc[(frame["QC Name"] != "Valid") | (frame["Value"] < 0), "Value"] = np.nan
 
         # Verify assumptions that are baked into all the code
         # mg^3 / g^3: data for 2008 contains a typo
-        if row["Unit"] != "µg/mg³" and row["Unit"] != "µg/m³":
-            logging.warning("Weird unit at {0}: '{1}'".format(row["Date"], row["Unit"]))
-            return None
-
-        if row["Duration"] != "1 Hr":
-            logging.warning("Weird duration at {0}: '{1}'".format(row["Date"], row["Duration"]))
-            return None
+        weird_unit = ~frame["Unit"].isin(["µg/mg³", "µg/m³"])
+        for date, unit in zip(frame["Date"][weird_unit], frame["Unit"][weird_unit]):
+            logging.warning("Weird unit at {0}: '{1}'".format(date, unit))
 
-        # Remove all the fields we don't need anymore
-        [row.pop(f) for f in ["Date (LST)", "Year", "Month", "Day", "Hour", "Unit", "Duration", "QC Name"]]
+        weird_duration = ~weird_unit & (frame["Duration"] != "1 Hr")
+        for date, duration in zip(frame["Date"][weird_duration], frame["Duration"][weird_duration]):
+            logging.warning("Weird duration at {0}: '{1}'".format(date, duration))
 
-        return row
+        return frame.loc[~(weird_unit | weird_duration), ["Site", "Parameter", "Date", "Value"]]
 
     @staticmethod
-    def _fix_dst_duplicates(rows):
+    def _fix_dst_duplicates(dates):
         """
         The software that calculates the recorded time exhibits a bug during the spring DST transition (this is strange
         because China doesn't have DST), so there are some duplicate entries.  These are fixed here.
-        :param rows: Hourly data.  May contain gaps; assumed to be sorted.
+        :param dates: Hourly datetime64[h] sample times.  May contain gaps; assumed to be sorted.  Fixed in place.
         :return: Nothing.
         """
-        row_dates = [row['Date'] for row in rows]
+        hours = dates.astype(np.int64) % 24
+        months = dates.astype('datetime64[M]').astype(np.int64) % 12 + 1
+        years = dates.astype('datetime64[Y]')
 
-        # Find up to one duplicate at 3am in the month of March; any others will be flagged.
-        for year in range(row_dates[0].date().year, row_dates[-1].date().year + 1):
-            march_begin = datetime.datetime(year, 3, 1)
-            march_end = datetime.datetime(year, 4, 1)
+        duplicates = np.flatnonzero((dates[:-1] == dates[1:]) & (hours[:-1] == 3) & (months[:-1] == 3))
 
-            # If we don't have data for March in a given year, then range(first_index, last_index - 1) will be empty.
-            first_index = bisect.bisect_left(row_dates, march_begin)
-            last_index = bisect.bisect_left(row_dates, march_end)
+        # Fix up to one duplicate per year; any others will be flagged.
+        _, first_in_year = np.unique(years[duplicates], return_index=True)
+        fixed = duplicates[first_in_year]
 
-            for i in range(first_index, last_index - 1):
-                if (row_dates[i] == row_dates[i + 1] and row_dates[i].time().hour == 3):
-                    rows[i]['Date'] += datetime.timedelta(hours = -1)
-                    logging.info("Fixed DST error at {0}".format(rows[i]['Date']))
-                    break
+        dates[fixed] -= np.timedelta64(1, 'h')
+        if len(fixed) > 0:
+            logging.info("Fixed %d DST duplicates, at %s", len(fixed), ", ".join(str(d.item()) for d in dates[fixed]))
 
-    @classmethod
-    def _sort_and_fill_gaps(cls, rows):
+    @staticmethod
+    def _fill_gaps(dates, values):
         """
-        Adds entries with None if any are missing.
-        :param rows:
-        :return:
+        Puts the samples on a dense hourly grid running from the first sample to the last, with NaN wherever there's
+        no sample.
+        :param dates: datetime64[h] sample times, sorted
+        :param values: The sample values
+        :return: The grid's dates and values, as two arrays of the same length
         """
-        import math
+        indexes = (dates - dates[0]).astype(np.int64)
 
-        rows.sort(key=lambda row: row["Date"])
-        AqiDataSet._fix_dst_duplicates(rows)
+        # do a quick duplicate check
+        duplicates = np.flatnonzero(np.diff(indexes) == 0)
+        if len(duplicates) > 0:
+            raise BaseException("Duplicate data for date {0}".format(dates[duplicates[0]].item()))
 
-        new_rows = []
+        grid = np.arange(dates[0], dates[-1] + np.timedelta64(1, 'h'))
+        grid_values = np.full(len(grid), np.nan)
+        grid_values[indexes] = values
 
-        previous_row = None
+        if (len(grid) > len(dates)):
+            logging.info("Added {0} empty elements where there were gaps".format(len(grid) - len(dates)))
 
-        for r in rows:
-            if (previous_row is not None):
-                # do a quick duplicate check
-                if (previous_row['Date'] == r['Date']):
-                    raise BaseException("Duplicate data for date {0}".format(r['Date']))
+        return grid, grid_values
 
-                date_to_add = previous_row['Date'] + datetime.timedelta(hours = 1)
-                while date_to_add < r['Date']:
-                    new_row = dict(r) # clone it
-                    new_row["Value"] = math.nan
-                    new_row["Date"] = date_to_add
-                    new_rows.append(new_row)
-                    date_to_add += datetime.timedelta(hours = 1)
+    @staticmethod
+    def _read_rows_from_csv_files(csv_files):
+        """
+        :return: The hourly sample times and values of all the files together, as returned by _fill_gaps
+        """
+        frame = pd.concat([AqiDataSet._load_csv_skip_header(f) for f in csv_files], ignore_index=True)
+
+        # Filter out the stuff we don't want
+        total_count = len(frame)
+        frame = frame[(frame["Site"] == "Beijing") & (frame["Parameter"] == "PM2.5")]
+        post_filter_count = len(frame)
+        if (post_filter_count < total_count):
+            logging.warning("Removed {0} rows that weren't Beijing / PM2.5".format(total_count - post_filter_count))
 
-            new_rows.append(r)
-            previous_row = r
+        frame = frame.sort_values("Date", kind="stable")
+        dates = frame["Date"].to_numpy().astype('datetime64[h]')
+        AqiDataSet._fix_dst_duplicates(dates)
 
-        if (len(new_rows) > len(rows)):
-            logging.info("Added {0} empty elements where there were gaps".format(len(new_rows) - len(rows)))
+        # Fill in gaps with invalid entries
+        return AqiDataSet._fill_gaps(dates, frame["Value"].to_numpy(np.float64))
 
-        return new_rows
+    # Bump this whenever a change to the parsing code would change the loaded data, so older caches aren't used
+    _CACHE_VERSION = 1
 
     @staticmethod
-    def _read_rows_from_csv_files(csv_files):
-        rows = []
+    def _cache_path(cache_dir, pattern):
+        # Each pattern gets its own cache, since different patterns can pick different files from the same directory
+        pattern_hash = hashlib.sha1(pattern.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(cache_dir, ".stateair_cache-{0}.npz".format(pattern_hash))
 
-        for f in csv_files:
-            rows += AqiDataSet._load_csv_skip_header(f)
+    @staticmethod
+    def _file_stamps(csv_files):
+        """
+        :return: The name, size and modification time of every file, sorted by name.  The cache is only used when all
+                 of these match; an mtime that went backwards (as when a file is restored from an archive) still
+                 counts as a change.
+        """
+        stats = [(os.path.basename(f), os.stat(f)) for f in csv_files]
+        stamps = sorted((name, stat.st_size, stat.st_mtime_ns) for name, stat in stats)
+        return ([name for name, _, _ in stamps],
+                np.array([size for _, size, _ in stamps], dtype=np.int64),
+                np.array([mtime for _, _, mtime in stamps], dtype=np.int64))
 
-        # Filter out the stuff we don't want
-        total_count = len(rows)
-        rows = [row for row in rows if row["Site"] == "Beijing" and row["Parameter"] == "PM2.5"]
-        post_filter_count = len(rows)
-        if (post_filter_count < total_count):
-            logging.warning("Removed {0} rows that weren't Beijing / PM2.5".format(total_count - post_filter_count))
+    @staticmethod
+    def _load_cache(cache_path, csv_files):
+        """
+        Loads data saved by _save_cache.
+        :return: The dates and values, or None if there's no usable cache: it doesn't exist, it was written by a
+                 different version of the parsing code, it was made from different files, or it can't be read.
+        """
+        if not os.path.exists(cache_path):
+            return None
 
-        # Sort by date and fill in gaps with invalid entries
-        return AqiDataSet._sort_and_fill_gaps(rows)
+        names, sizes, mtimes = AqiDataSet._file_stamps(csv_files)
+        try:
+            with np.load(cache_path) as cache:
+                if (int(cache['version']) != AqiDataSet._CACHE_VERSION or
+                        cache['names'].tolist() != names or
+                        not np.array_equal(cache['sizes'], sizes) or
+                        not np.array_equal(cache['mtimes'], mtimes)):
+                    return None
+
+                return cache['dates'], cache['values']
+        except Exception as e:
+            # A damaged cache (empty, truncated, not a zip file at all...) is just parsed over again
+            logging.warning("Ignoring unreadable cache '{0}': {1!r}".format(cache_path, e))
+            return None
+
+    @staticmethod
+    def _save_cache(cache_path, csv_files, dates, values):
+        names, sizes, mtimes = AqiDataSet._file_stamps(csv_files)
 
-    def __init__(self, csvPath, pattern="*.csv"):
+        # Written to a temporary file first, so a run that's interrupted never leaves half a cache behind
+        temp_path = cache_path + ".tmp"
+        try:
+            with open(temp_path, "wb") as file:
+                np.savez(file, version=AqiDataSet._CACHE_VERSION, names=np.array(names), sizes=sizes, mtimes=mtimes,
+                         dates=dates, values=values)
+                # Make sure the data is on disk before the rename, or a crash could leave an empty cache behind it
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            logging.warning("Couldn't save parsed data to '{0}': {1}".format(cache_path, e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def __init__(self, csvPath, pattern="*.csv", cache_dir=None):
+        """
+        :param cache_dir: If given, the parsed data is saved in this directory, and later loads of the same files
+                          read it from there instead of parsing the files again.
+        """
         csv_files = AqiDataSet._files_matching(csvPath, pattern)
         if len(csv_files) == 0:
             raise BaseException("Couldn't find any files in '{0}' matching '{1}'".format(csvPath, pattern))
 
-        logging.info("Preparing to parse %d AQI files" % len(csv_files))
+        # The data is stored as parallel arrays, one element per hour from the first sample to the last
+        cache_path = AqiDataSet._cache_path(cache_dir, pattern) if cache_dir is not None else None
+        cached = AqiDataSet._load_cache(cache_path, csv_files) if cache_path is not None else None
+        if cached is not None:
+            logging.info("Loading previously parsed data for %d AQI files from '%s'" % (len(csv_files), cache_path))
+            self._dates, self._values = cached
+        else:
+            logging.info("Preparing to parse %d AQI files" % len(csv_files))
+            self._dates, self._values = AqiDataSet._read_rows_from_csv_files(csv_files)
+            if cache_path is not None:
+                AqiDataSet._save_cache(cache_path, csv_files, self._dates, self._values)
+
+        self._uncertainties = np.where(np.isnan(self._values), np.nan, 0)
 
-        self.rows = [AqiDataPoint(r['Date'], r['Value']) for r in AqiDataSet._read_rows_from_csv_files(csv_files)]
-        self.row_dates = [r.date for r in self.rows]
+        logging.info("Loaded stateair.net AQI data with {0} rows".format(len(self._dates)))
+        logging.info("    Start: {0}".format(self._dates[0].item()))
+        logging.info("    End:   {0}".format(self._dates[-1].item()))
+
+        self.missing_count = int(np.isnan(self._values).sum())
+        logging.info("    Missing: {0} ({1}%)".format(self.missing_count, 100 * self.missing_count / len(self._dates)))
+
+        self._soa = None
+
+    @property
+    def rows(self):
+        return self.data_in_range()
+
+    def arrays(self):
+        """
+        Returns the data as an AqiDataArrays.  It's built on first use and then cached, so code that modifies the
+        values or uncertainties must call invalidate_arrays() when it's done.
+        :return:
+        """
+        if self._soa is None:
+            self._soa = AqiDataArrays(self)
 
-        logging.info("Loaded stateair.net AQI data with {0} rows".format(len(self.rows)))
-        logging.info("    Start: {0}".format(self.rows[0].date))
-        logging.info("    End:   {0}".format(self.rows[len(self.rows) - 1].date))
+        return self._soa
 
-        self.missing_count = len([r for r in self.rows if (not r.isvalid())])
-        logging.info("    Missing: {0} ({1}%)".format(self.missing_count, 100 * self.missing_count / len(self.rows)))
+    def invalidate_arrays(self):
+        self._soa = None
 
     def data_in_range(self, date_begin=None, date_end=None):
         """
@@ -190,10 +301,10 @@ class AqiDataSet:
         :return:
         """
         if date_begin is None:
-            date_begin = self.rows[0].date
+            date_begin = self._dates[0].item()
 
         if date_end is None:
-            date_end = self.rows[-1].date + datetime.timedelta(hours=1)
+            date_end = self._dates[-1].item() + _ONE_HOUR
 
         if type(date_begin) is datetime.date:
             date_begin = datetime.datetime.combine(date_begin, datetime.time())
@@ -205,15 +316,18 @@ class AqiDataSet:
 
 
 # Strongly coupled to AqiDataSet class
-class AqiDataRange(collections.Sequence):
+class AqiDataRange(collections.abc.Sequence):
 
     def __init__(self, aqi_data, date_begin: datetime.datetime, date_end: datetime.datetime):
         self.aqi_data = aqi_data
         self.date_begin = date_begin
         self.date_end = date_end
 
-        self.offset_into_data = int((self.date_begin - self.aqi_data.row_dates[0]).total_seconds()) // 3600
-        self._count = max(0, int((self.date_end - self.date_begin).total_seconds()) // 3600)
+        # Differences are taken in whole seconds and floored to hours, so bounds that aren't on the hour count only
+        # the complete hours between them
+        second_begin = np.datetime64(date_begin, 's')
+        self.offset_into_data = int((second_begin - self.aqi_data._dates[0]).astype(np.int64)) // 3600
+        self._count = max(0, int((np.datetime64(date_end, 's') - second_begin).astype(np.int64)) // 3600)
 
     def __len__(self):
         return self._count
@@ -221,7 +335,15 @@ class AqiDataRange(collections.Sequence):
     # Optimized for the case where either the same key is being requested, or
     # the next key is being requested
     def __getitem__(self, key):
-        import math
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._count)
+            if step == 1:
+                # Contiguous slices are just a narrower range over the same data
+                stop = max(start, stop)
+                return AqiDataRange(self.aqi_data, self.date_begin + start * _ONE_HOUR,
+                                    self.date_begin + stop * _ONE_HOUR)
+
+            return [self[i] for i in range(start, stop, step)]
 
         if key < 0:
             key += self._count
@@ -230,41 +352,115 @@ class AqiDataRange(collections.Sequence):
             raise IndexError()
 
         index = key + self.offset_into_data
-        if index < 0 or index >= len(self.aqi_data.row_dates):
+        if index < 0 or index >= len(self.aqi_data._dates):
             my_date = self.date_begin + datetime.timedelta(hours=key)
-            return AqiDataPoint(my_date, math.nan)
+            return AqiDataPoint(my_date, _NAN)
+
+        return AqiDataPoint(self.aqi_data._dates[index].item(), self.aqi_data._values[index].item(),
+                            self.aqi_data._uncertainties[index].item())
+
+    def __iter__(self):
+        lo, hi = self._overlap()
+        padding_before = min(self._count, max(0, lo - self.offset_into_data))
+        padding_after = padding_before + hi - lo
+
+        for key in range(padding_before):
+            yield AqiDataPoint(self.date_begin + key * _ONE_HOUR, _NAN)
+
+        # Converting the overlapping part of the arrays in one go is much cheaper than indexing them per element
+        for date, value, uncertainty in zip(self.aqi_data._dates[lo:hi].tolist(), self.aqi_data._values[lo:hi].tolist(),
+                                            self.aqi_data._uncertainties[lo:hi].tolist()):
+            yield AqiDataPoint(date, value, uncertainty)
+
+        for key in range(padding_after, self._count):
+            yield AqiDataPoint(self.date_begin + key * _ONE_HOUR, _NAN)
+
+    def _overlap(self):
+        """
+        Returns the [lo, hi) indexes into the data set's arrays of the part of this range that lies within the data.
+        """
+        lo = min(max(0, self.offset_into_data), len(self.aqi_data._dates))
+        hi = max(lo, min(len(self.aqi_data._dates), self.offset_into_data + self._count))
+        return lo, hi
+
+    def values(self):
+        """
+        Returns the values in this range as a NumPy array.  When the range lies within the data set this is a view of
+        the data set's own storage, not a copy; otherwise the part outside the data is filled with NaN.
+        """
+        lo, hi = self._overlap()
+        if hi - lo == self._count:
+            return self.aqi_data._values[lo:hi]
+
+        values = np.full(self._count, np.nan)
+        values[lo - self.offset_into_data:hi - self.offset_into_data] = self.aqi_data._values[lo:hi]
+        return values
 
-        return self.aqi_data.rows[index]
+    def mean(self):
+        """
+        Returns the mean of the valid data points in this range, or NaN if it doesn't have any.
+        """
+        lo, hi = self._overlap()
+        return _nan_mean(self.aqi_data._values, lo, hi)
 
     def valid_data_point_count(self):
-        return len([dp for dp in self if dp.isvalid()])
+        # Only the part of the range that overlaps the data set can contain valid points; the rest is NaN padding
+        lo, hi = self._overlap()
+        return int(np.count_nonzero(~np.isnan(self.aqi_data._values[lo:hi])))
+
+
+class AqiDataArrays:
+    """
+    The rows of an AqiDataSet as parallel NumPy arrays, one element per hourly sample.  Reports use these to work on
+    whole columns at once instead of reading attributes off every AqiDataPoint.  values and uncertainty are the data
+    set's own storage, so writing to them changes the data set; the rest is derived from it.
+    """
+
+    def __init__(self, aqi_data):
+        dates = aqi_data._dates
+
+        self.values = aqi_data._values
+        self.uncertainty = aqi_data._uncertainties
+        self.valid = ~np.isnan(self.values)
+
+        self.year = (dates.astype('datetime64[Y]').astype(np.int64) + 1970).astype(np.int16)
+        self.month = (dates.astype('datetime64[M]').astype(np.int64) % 12 + 1).astype(np.int8)
+        self.hour = (dates - dates.astype('datetime64[D]')).astype(np.int8)
+        # Seconds since 1970-01-01, in the same (local) time as the dates themselves
+        self.epoch = dates.astype('datetime64[s]').astype(np.int64)
 
 
 class AqiDataPoint:
-    def __init__(self, date, value, uncertainty=0):
-        import math
+    """
+    A single sample.  AqiDataRange creates these on demand from the data set's arrays, so they're snapshots: changing
+    one doesn't change the data set.
+    """
+    __slots__ = ('date', 'value', 'uncertainty')
+
+    def __init__(self, date, value, uncertainty=None):
         self.date = date
-        self.value = value
-        if math.isnan(self.value):
-            self.uncertainty = math.nan
+        # Always a float, so that isvalid() can't fail
+        self.value = float(value)
+        if uncertainty is not None:
+            self.uncertainty = uncertainty
+        elif _isnan(self.value):
+            self.uncertainty = _NAN
         else:
             self.uncertainty = 0
 
     def isvalid(self):
-        import math
-        try:
-            return not math.isnan(self.value)
-        except TypeError as e:
-            print(self.value)
-            raise Exception("Nope nope nope")
+        return not _isnan(self.value)
 
 
 class UnitTests(unittest.TestCase):
 
-    def test_data_load(self):
-        import math
+    @classmethod
+    def setUpClass(cls):
+        # None of the tests modify the data, so it's only loaded once
+        cls.data = AqiDataSet(os.path.join("unittest", "test-data"), "test.csv")
 
-        data = AqiDataSet("unittest\\test-data", "test.csv")
+    def test_data_load(self):
+        data = self.data
 
         self.assertEqual(len(data.rows), 16, "row count")
         self.assertEqual(data.missing_count, 6, "missing_count")
@@ -283,7 +479,7 @@ class UnitTests(unittest.TestCase):
         pass
 
     def test_data_in_range(self):
-        data = AqiDataSet("unittest\\test-data", "test.csv")
+        data = self.data
 
         my_range = data.data_in_range(datetime.date(2014, 2, 1), datetime.date(2014, 2, 4))
         self.assertEqual(len(my_range), 72, "empty set")
@@ -292,6 +488,7 @@ class UnitTests(unittest.TestCase):
         my_range = data.data_in_range(datetime.date(2014, 4, 1), datetime.date(2014, 2, 4))
         self.assertEqual(len(my_range), 0, "empty set")
         self.assertEqual(my_range.valid_data_point_count(), 0, "empty set")
+        self.assertTrue(math.isnan(my_range.mean()), "empty set has no mean")
 
         my_range = data.data_in_range(datetime.date(2014, 4, 1), datetime.date(2014, 4, 4))
         self.assertEqual(len(my_range), 72, "empty set")
@@ -304,6 +501,19 @@ class UnitTests(unittest.TestCase):
         self.assertEqual(len(my_range), 9, "partially overlapping set")
         self.assertEqual(my_range.valid_data_point_count(), 7, "missing some valid data points")
         self.assertEqual(my_range[1].value, 131, "first valid item's value")
+        self.assertAlmostEqual(my_range.mean(), 127, 3, "mean of the valid data points")
+        self.assertEqual([p.date for p in my_range], [my_range[i].date for i in range(9)], "iterated dates")
+
+        my_subrange = my_range[1:3]
+        self.assertEqual(len(my_subrange), 2, "slice")
+        self.assertEqual(my_subrange[0].value, 131, "slice's first item's value")
+
+        # Bounds that aren't on the hour only cover the complete hours between them
+        my_range = data.data_in_range(datetime.datetime(2014, 3, 9, 0, 30), datetime.datetime(2014, 3, 9, 1))
+        self.assertEqual(len(my_range), 0, "less than an hour")
+        my_range = data.data_in_range(datetime.datetime(2014, 3, 9, 0, 30), datetime.datetime(2014, 3, 9, 2))
+        self.assertEqual(len(my_range), 1, "an hour and a half")
+        self.assertEqual(my_range[0].value, 131, "value of the hour the range starts in")
 
         # Check behavior where start/end dates are implied
         my_range = data.data_in_range()
@@ -312,9 +522,69 @@ class UnitTests(unittest.TestCase):
         self.assertEqual(my_range[15].date, datetime.datetime(2014, 3, 9, 15), 15)
 
 
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            csv_file = os.path.join(temp_dir, "test.csv")
+            shutil.copyfile(os.path.join("unittest", "test-data", "test.csv"), csv_file)
+            shutil.copyfile(os.path.join("unittest", "test-data", "test2.csv"), os.path.join(temp_dir, "test2.csv"))
+
+            def load_without_parsing(pattern):
+                with unittest.mock.patch.object(AqiDataSet, "_read_rows_from_csv_files",
+                                                side_effect=AssertionError("should have loaded from the cache")):
+                    return AqiDataSet(temp_dir, pattern, cache_dir=temp_dir)
+
+            # Nothing is cached at first, so the file is parsed and the result saved
+            data = AqiDataSet(temp_dir, "test.csv", cache_dir=temp_dir)
+            self.assertEqual(data.rows[0].value, 131, "parsed value")
+
+            data = load_without_parsing("test.csv")
+            self.assertEqual(len(data.rows), 16, "cached row count")
+            self.assertEqual(data.missing_count, 6, "cached missing_count")
+            self.assertEqual(data.rows[0].value, 131, "cached value")
+
+            # A different pattern in the same directory gets its own cache, and leaves the first one alone
+            AqiDataSet(temp_dir, "test2.csv", cache_dir=temp_dir)
+            load_without_parsing("test2.csv")
+            load_without_parsing("test.csv")
+
+            # Change the file without changing its size, and make it look older, as restoring from an archive would
+            mtime = os.stat(csv_file).st_mtime_ns
+            with open(csv_file, "r", encoding="latin-1", newline="") as file:
+                contents = file.read()
+            with open(csv_file, "w", encoding="latin-1", newline="") as file:
+                file.write(contents.replace(",2014,3,9,0,131,", ",2014,3,9,0,130,"))
+            os.utime(csv_file, ns=(mtime - 10 ** 10, mtime - 10 ** 10))
+
+            data = AqiDataSet(temp_dir, "test.csv", cache_dir=temp_dir)
+            self.assertEqual(data.rows[0].value, 130, "stale cache should be ignored")
+
+            # A cache written by a different version of the parsing code isn't used either
+            with unittest.mock.patch.object(AqiDataSet, "_CACHE_VERSION", AqiDataSet._CACHE_VERSION + 1), \
+                    unittest.mock.patch.object(AqiDataSet, "_read_rows_from_csv_files",
+                                               wraps=AqiDataSet._read_rows_from_csv_files) as read_rows:
+                AqiDataSet(temp_dir, "test.csv", cache_dir=temp_dir)
+            self.assertEqual(read_rows.call_count, 1, "old cache version should be ignored")
+
+            # Damaged caches are parsed over, not fatal
+            cache_path = AqiDataSet._cache_path(temp_dir, "test.csv")
+            for damaged_contents in [b"", b"not a zip file", b"PK\x03\x04 truncated zip"]:
+                with open(cache_path, "wb") as file:
+                    file.write(damaged_contents)
+
+                data = AqiDataSet(temp_dir, "test.csv", cache_dir=temp_dir)
+                self.assertEqual(data.rows[0].value, 130, "damaged cache should be parsed over")
+                load_without_parsing("test.csv")
+
+            self.assertEqual(sorted(f for f in os.listdir(temp_dir) if f.endswith(".tmp")), [], "temporary files")
+
+    def test_missing_header(self):
+        # The header in this file comes after more preamble lines than are searched
+        with self.assertRaisesRegex(BaseException, "Couldn't find CSV header"):
+            AqiDataSet(os.path.join("unittest", "test-data"), "test-no-header.csv")
+
     def test_single_data_point(self):
 
-        data = AqiDataSet("unittest\\test-data", "test.csv")
+        data = self.data
 
         my_range = data.data_in_range(datetime.datetime(2014, 3, 9, 0), datetime.datetime(2014, 3, 9, 1))
         self.assertEqual(len(my_range), 1)